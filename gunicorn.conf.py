@@ -0,0 +1,9 @@
+import multiprocessing
+import os
+
+# App Service 預設用 gunicorn 啟動 app:app, gunicorn 會自動讀取這個設定檔.
+# Quart 是 ASGI app, 改用 uvicorn worker; uvicorn 會自動使用已安裝的 uvloop 與 httptools
+worker_class = 'uvicorn_worker.UvicornWorker'
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# 讓每個 worker 知道總共有幾個 worker, 以平分 OpenAI 的 RPM / TPM 額度
+os.environ['WEB_CONCURRENCY'] = str(workers)